@@ -1,6 +1,13 @@
+import functools
+
 import numpy as np
 import tensorflow as tf
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def register_keras_custom_object(cls):
     tf.keras.utils.get_custom_objects()[cls.__name__] = cls
@@ -63,6 +70,46 @@ def sparsemax(logits, axis=-1):
     return output
 
 
+def build_sparsemax(num_features, jit_compile=False):
+    """Builds a sparsemax over the last axis of a fixed width `[batch, num_features]` tensor.
+    As the width is known ahead of time, the sort and the threshold search use static
+    shapes, unlike the dynamic shape ops of `sparsemax`.
+    Args:
+        num_features: Integer, size of the last axis of the logits.
+        jit_compile: Boolean, whether to compile the sparsemax with XLA.
+    Returns:
+        A function computing the sparsemax of a `[batch, num_features]` tensor.
+    """
+    @tf.function(jit_compile=jit_compile)
+    def _sparsemax(logits):
+        logits = tf.ensure_shape(tf.convert_to_tensor(logits, name="logits"), [None, num_features])
+
+        # sort z
+        z_sorted, _ = tf.nn.top_k(logits, k=num_features)
+
+        # calculate k(z)
+        z_cumsum = tf.math.cumsum(z_sorted, axis=-1)
+        k = tf.range(1, num_features + 1, dtype=logits.dtype)
+        z_check = 1 + k * z_sorted > z_cumsum
+        k_z = tf.math.reduce_sum(tf.cast(z_check, tf.int32), axis=-1)
+
+        # calculate tau(z), see `_compute_2d_sparsemax` for the handling of k_z = 0.
+        k_z_safe = tf.math.maximum(k_z, 1)
+        tau_sum = tf.gather(z_cumsum, k_z_safe - 1, batch_dims=1)
+        tau_z = (tau_sum - 1) / tf.cast(k_z, logits.dtype)
+
+        # calculate p
+        p = tf.math.maximum(
+            tf.cast(0, logits.dtype), logits - tf.expand_dims(tau_z, -1))
+        # If k_z = 0 or if z = nan, then the input is invalid
+        invalid = tf.math.logical_or(
+            tf.math.equal(k_z, 0), tf.math.is_nan(z_cumsum[:, -1]))
+        return tf.where(tf.expand_dims(invalid, axis=-1),
+                        tf.cast(float("nan"), logits.dtype), p)
+
+    return _sparsemax
+
+
 def _swap_axis(logits, dim_index, last_index, **kwargs):
     return tf.transpose(
         logits,
@@ -129,3 +176,89 @@ def _compute_2d_sparsemax(logits):
     return p_safe
 
 
+def build_numba_mask_step(relaxation_factor, epsilon):
+    """Builds a CPU fallback for the feature mask update of a TabNet decision step.
+    The complementary mask product, sparsemax, relaxation update, feature selection and
+    entropy are computed row by row in a single Numba kernel, which is called through
+    `tf.numpy_function`. It has no gradient, and can only be used for inference.
+    Args:
+        relaxation_factor: Float, relaxation factor of the TabNet model.
+        epsilon: Float, epsilon of the mask entropy.
+    Returns:
+        A function mapping `(mask_logits, features, complementary_mask)` to
+        `(mask_values, complementary_mask, masked_features, entropy)`.
+    Raises:
+        ImportError: In case Numba is not installed.
+    """
+    if numba is None:
+        raise ImportError("Numba is required for the CPU backend, install it with `pip install numba`.")
+
+    relaxation_factor = np.float32(relaxation_factor)
+    epsilon = np.float32(epsilon)
+
+    def _numpy_step(mask_logits, features, complementary_mask):
+        kernel = _numba_mask_step_kernel()
+        return kernel(mask_logits, features, complementary_mask, relaxation_factor, epsilon)
+
+    def _mask_step(mask_logits, features, complementary_mask):
+        dtype = features.dtype
+        inputs = [tf.cast(x, tf.float32) for x in [mask_logits, features, complementary_mask]]
+        mask_values, complementary_mask, masked_features, entropy = tf.numpy_function(
+            _numpy_step, inputs, [tf.float32] * 4)
+
+        for x in [mask_values, complementary_mask, masked_features]:
+            x.set_shape(inputs[0].shape)
+        entropy.set_shape(inputs[0].shape[:1])
+
+        return (tf.cast(mask_values, dtype), tf.cast(complementary_mask, dtype),
+                tf.cast(masked_features, dtype), entropy)
+
+    return _mask_step
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_mask_step_kernel():
+    """Compiles the Numba kernel of `build_numba_mask_step` on first use."""
+    @numba.njit("Tuple((f4[:, :], f4[:, :], f4[:, :], f4[:]))(f4[:, :], f4[:, :], f4[:, :], f4, f4)",
+                parallel=True, cache=True)
+    def kernel(mask_logits, features, complementary_mask, relaxation_factor, epsilon):
+        obs, dims = mask_logits.shape
+        mask_values = np.empty((obs, dims), dtype=np.float32)
+        new_complementary_mask = np.empty((obs, dims), dtype=np.float32)
+        masked_features = np.empty((obs, dims), dtype=np.float32)
+        entropy = np.empty(obs, dtype=np.float32)
+
+        for i in numba.prange(obs):
+            z = mask_logits[i] * complementary_mask[i]
+            z_sorted = np.sort(z)[::-1]
+
+            # calculate k(z) and the cumulative sum at k(z)
+            k_z = 0
+            z_cumsum = np.float32(0)
+            tau_sum = np.float32(0)
+            for j in range(dims):
+                z_cumsum += z_sorted[j]
+                if 1 + (j + 1) * z_sorted[j] > z_cumsum:
+                    k_z = j + 1
+                    tau_sum = z_cumsum
+
+            # If k_z = 0 or if z = nan, then the input is invalid, see `_compute_2d_sparsemax`.
+            if k_z == 0 or np.isnan(z_cumsum):
+                mask_values[i] = np.nan
+                new_complementary_mask[i] = np.nan
+                masked_features[i] = np.nan
+                entropy[i] = np.nan
+            else:
+                tau_z = (tau_sum - 1) / k_z
+                row_entropy = np.float32(0)
+                for j in range(dims):
+                    p = max(z[j] - tau_z, np.float32(0))
+                    mask_values[i, j] = p
+                    new_complementary_mask[i, j] = complementary_mask[i, j] * (relaxation_factor - p)
+                    masked_features[i, j] = p * features[i, j]
+                    row_entropy -= p * np.log(p + epsilon)
+                entropy[i] = row_entropy
+
+        return mask_values, new_complementary_mask, masked_features, entropy
+
+    return kernel
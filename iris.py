@@ -15,23 +15,31 @@ def transform(ds):
 
 
 col_names = ['sepal_length', 'sepal_width', 'petal_length', 'petal_width']
-ds_train = tfds.load(name="iris", split=tfds.Split.TRAIN)
-ds_train = ds_train.shuffle(150)
-ds_train = ds_train.map(transform)
-ds_train = ds_train.batch(BATCH_SIZE)
 
 feature_columns = []
 for col_name in col_names:
     feature_columns.append(tf.feature_column.numeric_column(col_name))
 
-model = tabnet.TabNetClassification(feature_columns, num_classes=3,
+# The feature columns are applied in the input pipeline, so the model receives dense tensors.
+input_features = tf.keras.layers.DenseFeatures(feature_columns)
+
+ds_train = tfds.load(name="iris", split=tfds.Split.TRAIN)
+ds_train = ds_train.shuffle(150)
+ds_train = ds_train.map(transform)
+ds_train = ds_train.batch(BATCH_SIZE)
+ds_train = ds_train.map(lambda x, y: (input_features(x), y), num_parallel_calls=tf.data.AUTOTUNE)
+ds_train = ds_train.prefetch(tf.data.AUTOTUNE)
+
+model = tabnet.TabNetClassification(None, num_classes=3,
+                                    num_features=len(feature_columns),
                                     feature_dim=4, output_dim=4,
                                     num_decision_steps=2, relaxation_factor=1.5,
-                                    batch_momentum=0.98, virtual_batch_size=None)
+                                    batch_momentum=0.98, virtual_batch_size=None,
+                                    jit_compile=True)
 
 lr = tf.keras.optimizers.schedules.InverseTimeDecay(0.01, decay_steps=50, decay_rate=0.5, staircase=False)
 optimizer = tf.keras.optimizers.Adam(lr)
-model.compile(optimizer, loss='categorical_crossentropy', metrics=['accuracy'], run_eagerly=True)
+model.compile(optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
 
 model.fit(ds_train, epochs=100)
 
@@ -1,10 +1,41 @@
 import numpy as np
 import tensorflow as tf
 
-from custom_objects import glu, sparsemax
+from custom_objects import build_numba_mask_step, build_sparsemax, glu
 
 
-class TransformBlock(tf.keras.Model):
+def _mask_entropy(mask_values, epsilon):
+    """Per sample entropy of a feature selection mask.
+
+    It is fused into a single kernel when the decision steps are compiled with XLA.
+    """
+    return tf.reduce_sum(-mask_values * tf.math.log(mask_values + epsilon), axis=1)
+
+
+def enable_graph_optimizations(auto_mixed_precision=False):
+    """Makes sure the grappler rewrites used by the TabNet graph are enabled.
+
+    The layout, constant folding, shape and remapping optimizers are grappler defaults,
+    so this only matters if they were turned off. Grappler auto mixed precision is only
+    set when `auto_mixed_precision` is requested, and must not be combined with a Keras
+    mixed precision policy. Grappler does not rewrite functions compiled with XLA.
+
+    This sets process wide options, and should be called at start up before any model
+    is built.
+    """
+    options = {
+        'layout_optimizer': True,
+        'constant_folding': True,
+        'shape_optimization': True,
+        'remapping': True,
+    }
+    if auto_mixed_precision:
+        options['auto_mixed_precision'] = True
+
+    tf.config.optimizer.set_experimental_options(options)
+
+
+class TransformBlock(tf.keras.layers.Layer):
 
     def __init__(self, features,
                  momentum,
@@ -16,15 +47,68 @@ class TransformBlock(tf.keras.Model):
         self.momentum = momentum
         self.virtual_batch_size = virtual_batch_size
 
-        self.transform = tf.keras.layers.Dense(self.features, use_bias=False)
         self.bn = tf.keras.layers.BatchNormalization(axis=-1, momentum=momentum,
-                                                     virtual_batch_size=virtual_batch_size)
+                                                     virtual_batch_size=virtual_batch_size,
+                                                     dtype=self.dtype_policy)
+
+        self._folded_kernel = None
+        self._folded_bias = None
+
+    def build(self, input_shape):
+        # A raw kernel avoids the per call overhead of a Dense layer, as the block is
+        # invoked several times per decision step.
+        self.kernel = self.add_weight('kernel', shape=[input_shape[-1], self.features],
+                                      initializer='glorot_uniform')
+        super(TransformBlock, self).build(input_shape)
 
     def call(self, inputs, training=None):
-        x = self.transform(inputs)
+        if self._folded_kernel is not None:
+            if training:
+                raise ValueError("TransformBlock cannot be trained after its batch norm was folded.")
+
+            return tf.matmul(inputs, self._folded_kernel) + self._folded_bias
+
+        x = tf.matmul(inputs, self.kernel)
         x = self.bn(x, training=training)
         return x
 
+    def set_inference_mode(self):
+        """Replaces the batch norm by one without virtual batches, which are not needed at inference.
+
+        The block must be built, and should not be trained afterwards.
+        """
+        if self.virtual_batch_size is None:
+            return
+
+        if not self.built:
+            raise ValueError("TransformBlock must be built before setting it to inference mode.")
+
+        bn = tf.keras.layers.BatchNormalization(axis=-1, momentum=self.momentum,
+                                                dtype=self.bn.dtype_policy)
+        bn.build(tf.TensorShape([None, self.features]))
+        # With virtual batches, the batch norm params have an extra `[1, 1, features]` shape.
+        bn.set_weights([np.reshape(w, [-1]) for w in self.bn.get_weights()])
+
+        self.bn = bn
+        self.virtual_batch_size = None
+
+    def fold_bn(self):
+        """Folds the batch norm moving statistics into the dense kernel for inference.
+
+        The block must be built, and should not be trained after folding.
+        """
+        if not self.built:
+            raise ValueError("TransformBlock must be built before folding its batch norm.")
+
+        # With virtual batches, the batch norm params have an extra `[1, 1, features]` shape.
+        scale = self.bn.gamma * tf.math.rsqrt(self.bn.moving_variance + self.bn.epsilon)
+        bias = self.bn.beta - self.bn.moving_mean * scale
+        scale = tf.reshape(scale, [self.features])
+        bias = tf.reshape(bias, [self.features])
+
+        self._folded_kernel = tf.cast(self.kernel * scale, self.compute_dtype)
+        self._folded_bias = tf.cast(bias, self.compute_dtype)
+
 
 class TabNet(tf.keras.Model):
 
@@ -37,6 +121,8 @@ class TabNet(tf.keras.Model):
                  batch_momentum=0.98,
                  virtual_batch_size=None,
                  lambd_sparsity=1e-5,
+                 jit_compile=False,
+                 cpu_backend=False,
                  **kwargs):
         """
         Tensorflow 2.0 implementation of [tf-TabNet: Attentive Interpretable Tabular Learning](https://arxiv.org/abs/1908.07442)
@@ -64,8 +150,10 @@ class TabNet(tf.keras.Model):
             - Initially large learning rate is important, which should be gradually decayed until convergence.
 
         Args:
-            feature_columns:
-            num_features:
+            feature_columns: list of feature columns, or None if the model receives dense
+                `[batch, num_features]` tensors which were already transformed, e.g. in the
+                `tf.data` input pipeline.
+            num_features: required if `feature_columns` is None.
             feature_dim:
             output_dim:
             num_decision_steps:
@@ -73,10 +161,20 @@ class TabNet(tf.keras.Model):
             batch_momentum:
             virtual_batch_size:
             lambd_sparsity:
+            jit_compile: bool, whether to compile the decision steps with XLA.
+            cpu_backend: bool, whether to compute the feature mask updates at inference with a
+                Numba kernel, which reduces the op dispatch overhead of small batches on CPU.
+                Requires Numba, and cannot be combined with `jit_compile`.
             **kwargs:
         """
         super(TabNet, self).__init__(**kwargs)
 
+        if feature_columns is None and num_features is None:
+            raise ValueError("`num_features` must be provided when `feature_columns` is None.")
+
+        if cpu_backend and jit_compile:
+            raise ValueError("`cpu_backend` cannot be combined with `jit_compile`.")
+
         self.feature_columns = feature_columns
         self.num_features = num_features if num_features is not None else len(feature_columns)
         self.feature_dim = feature_dim
@@ -87,71 +185,116 @@ class TabNet(tf.keras.Model):
         self.batch_momentum = batch_momentum
         self.virtual_batch_size = virtual_batch_size
         self.epsilon = lambd_sparsity
+        self.jit_compile = jit_compile
+        self.cpu_backend = cpu_backend
+
+        self._inv_sqrt2 = tf.constant(np.sqrt(0.5), dtype=self.compute_dtype)
+        self._inv_steps_m1 = tf.constant(1.0 / max(self.num_decision_steps - 1, 1), dtype=self.compute_dtype)
+        # The entropy is accumulated in float32, so it is scaled without the compute dtype rounding.
+        self._inv_steps_m1_f32 = tf.constant(1.0 / max(self.num_decision_steps - 1, 1), dtype=tf.float32)
+        self._sparsemax = build_sparsemax(self.num_features, jit_compile=self.jit_compile)
+        if self.cpu_backend:
+            self._mask_step = build_numba_mask_step(self.relaxation_factor, self.epsilon)
+
+        if feature_columns is not None:
+            self.input_features = tf.keras.layers.DenseFeatures(feature_columns)
+        else:
+            self.input_features = None
+        # The sublayers follow the policy of this model, which may differ from the global one.
+        self.input_bn = tf.keras.layers.BatchNormalization(axis=-1, momentum=batch_momentum,
+                                                           dtype=self.dtype_policy)
+
+        self.transform_f1 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size,
+                                           dtype=self.dtype_policy)
+        self.transform_f2 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size,
+                                           dtype=self.dtype_policy)
+        self.transform_f3 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size,
+                                           dtype=self.dtype_policy)
+        self.transform_f4 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size,
+                                           dtype=self.dtype_policy)
+        self.transform_coef = TransformBlock(self.num_features, self.batch_momentum, self.virtual_batch_size,
+                                             dtype=self.dtype_policy)
+
+        self._step_fn = self._build_step_fn()
 
-        self.input_features = tf.keras.layers.DenseFeatures(feature_columns)
-        self.input_bn = tf.keras.layers.BatchNormalization(axis=-1, momentum=batch_momentum)
+    def call(self, inputs, training=None):
+        if self.input_features is not None:
+            features = self.input_features(inputs)
+        else:
+            features = inputs
 
-        self.transform_f1 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size)
-        self.transform_f2 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size)
-        self.transform_f3 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size)
-        self.transform_f4 = TransformBlock(2 * self.feature_dim, self.batch_momentum, self.virtual_batch_size)
-        self.transform_coef = TransformBlock(self.num_features, self.batch_momentum, self.virtual_batch_size)
+        return self._step_fn(features, training=training)
 
-    def call(self, inputs, training=None):
-        features = self.input_features(inputs)
+    def _decision_steps(self, features, training=None):
         features = self.input_bn(features, training=training)
 
         batch_size = tf.shape(features)[0]
 
         # Initializes decision-step dependent variables.
-        output_aggregated = tf.zeros([batch_size, self.output_dim])
         masked_features = features
-        mask_values = tf.zeros([batch_size, self.num_features])
-        aggregated_mask_values = tf.zeros([batch_size, self.num_features])
         complemantary_aggregated_mask_values = tf.ones(
-            [batch_size, self.num_features])
+            [batch_size, self.num_features], dtype=features.dtype)
 
-        total_entropy = 0.0
-        for ni in tf.range(self.num_decision_steps):
+        # Per step contributions, which are reduced once after the loop. As the loop is
+        # unrolled, plain lists are used instead of a TensorArray, and each tf.add_n
+        # reads all steps in a single op without stacking them first.
+        decision_outs = []
+        step_mask_values = []
+        step_entropies = []
+
+        for ni in range(self.num_decision_steps):
 
             # Feature transformer with two shared and two decision step dependent
             # blocks is used below.
+            # Each block consumes the GLU output of the previous block, and each step
+            # consumes the mask of the previous step, so these matmuls cannot be packed
+            # into a single GEMM.
             transform_f1 = self.transform_f1(masked_features, training=training)
             transform_f1 = glu(transform_f1, self.feature_dim)
 
-            transform_f2 = self.transform_f2(transform_f1, training=training)
-            transform_f2 = (glu(transform_f2, self.feature_dim) +
-                            transform_f1) * np.sqrt(0.5)
-
-            transform_f3 = self.transform_f3(transform_f2, training=training)
-            transform_f3 = (glu(transform_f3, self.feature_dim) +
-                            transform_f2) * np.sqrt(0.5)
-
-            transform_f4 = self.transform_f4(transform_f3, training=training)
-            transform_f4 = (glu(transform_f4, self.feature_dim) +
-                            transform_f3) * np.sqrt(0.5)
+            transform_f2 = self._residual_glu(self.transform_f2, transform_f1, training)
+            transform_f3 = self._residual_glu(self.transform_f3, transform_f2, training)
+            transform_f4 = self._residual_glu(self.transform_f4, transform_f3, training)
 
             if ni > 0:
                 decision_out = tf.nn.relu(transform_f4[:, :self.output_dim])
 
                 # Decision aggregation.
-                output_aggregated += decision_out
+                decision_outs.append(decision_out)
 
                 # Aggregated masks are used for visualization of the
                 # feature importance attributes.
                 scale_agg = tf.reduce_sum(decision_out, axis=1, keepdims=True)
-                scale_agg = scale_agg / (self.num_decision_steps - 1)
+                scale_agg = scale_agg * self._inv_steps_m1
 
-                aggregated_mask_values += mask_values * scale_agg
-
-            features_for_coef = (transform_f4[:, self.output_dim:])
+                step_mask_values.append(mask_values * scale_agg)
 
             if (ni < self.num_decision_steps - 1):
+                features_for_coef = (transform_f4[:, self.output_dim:])
+
                 # Determines the feature masks via linear and nonlinear
                 # transformations, taking into account of aggregated feature use.
                 mask_values = self.transform_coef(features_for_coef, training=training)
+
+                if self.cpu_backend and not training:
+                    # The mask update chain below is computed by a single Numba kernel.
+                    (mask_values, complemantary_aggregated_mask_values,
+                     masked_features, entropy) = self._mask_step(
+                        mask_values, features, complemantary_aggregated_mask_values)
+                    step_entropies.append(tf.reduce_mean(entropy))
+                    continue
+
                 mask_values *= complemantary_aggregated_mask_values
-                mask_values = sparsemax(mask_values, axis=-1)
+
+                # Sparsemax and the entropy are always computed in float32 for
+                # numerical stability under mixed precision.
+                mask_values = self._sparsemax(tf.cast(mask_values, tf.float32))
+
+                # Entropy is used to penalize the amount of sparsity in feature
+                # selection.
+                step_entropies.append(tf.reduce_mean(_mask_entropy(mask_values, self.epsilon)))
+
+                mask_values = tf.cast(mask_values, features.dtype)
 
                 # Relaxation factor controls the amount of reuse of features between
                 # different decision blocks and updated with the values of
@@ -159,15 +302,8 @@ class TabNet(tf.keras.Model):
                 complemantary_aggregated_mask_values *= (
                         self.relaxation_factor - mask_values)
 
-                # Entropy is used to penalize the amount of sparsity in feature
-                # selection.
-                total_entropy += tf.reduce_mean(
-                    tf.reduce_sum(
-                        -mask_values * tf.math.log(mask_values + self.epsilon), axis=1)) / (
-                        tf.cast(self.num_decision_steps - 1, tf.float32))
-
                 # Feature selection.
-                masked_features = tf.multiply(mask_values, features)
+                masked_features = mask_values * features
 
                 # # Visualization of the feature selection mask at decision step ni
                 # tf.summary.image(
@@ -175,6 +311,15 @@ class TabNet(tf.keras.Model):
                 #     tf.expand_dims(tf.expand_dims(mask_values, 0), 3),
                 #     max_outputs=1)
 
+        if self.num_decision_steps > 1:
+            output_aggregated = tf.add_n(decision_outs)
+            aggregated_mask_values = tf.add_n(step_mask_values)
+            total_entropy = tf.add_n(step_entropies) * self._inv_steps_m1_f32
+        else:
+            output_aggregated = tf.zeros([batch_size, self.output_dim], dtype=features.dtype)
+            aggregated_mask_values = tf.zeros([batch_size, self.num_features], dtype=features.dtype)
+            total_entropy = 0.0
+
         # Visualization of the aggregated feature importances
         # tf.summary.image(
         #     "Aggregated mask",
@@ -183,6 +328,39 @@ class TabNet(tf.keras.Model):
 
         return output_aggregated, total_entropy
 
+    def freeze_for_inference(self, fold_bn=True):
+        """Prepares every transform block for inference.
+
+        The virtual batches of the batch norm layers are dropped and, if `fold_bn` is set,
+        the batch norm is folded into the dense kernel, which removes a full elementwise
+        pass per block. The model should not be trained afterwards.
+        """
+        for block in [self.transform_f1, self.transform_f2, self.transform_f3,
+                      self.transform_f4, self.transform_coef]:
+            block.set_inference_mode()
+            if fold_bn:
+                block.fold_bn()
+
+        # Traced graphs still hold the training time batch norm ops, so they must be rebuilt.
+        self._step_fn = self._build_step_fn()
+        self.predict_function = None
+        self.test_function = None
+
+    def _build_step_fn(self):
+        # Keras already traces `call` outside of `run_eagerly`, so the decision steps are
+        # only wrapped in their own function when they are XLA compiled. Feature columns
+        # are resolved outside of it, as DenseFeatures may contain ops which cannot be
+        # XLA compiled.
+        if self.jit_compile:
+            return tf.function(self._decision_steps, jit_compile=True)
+
+        return self._decision_steps
+
+    def _residual_glu(self, transform_block, prev, training=None):
+        """GLU block with a normalized residual connection to its input."""
+        x = transform_block(prev, training=training)
+        return (glu(x, self.feature_dim) + prev) * self._inv_sqrt2
+
 
 class TabNetClassification(tf.keras.Model):
 
@@ -196,6 +374,8 @@ class TabNetClassification(tf.keras.Model):
                  batch_momentum=0.98,
                  virtual_batch_size=None,
                  lambd_sparsity=1e-5,
+                 jit_compile=False,
+                 cpu_backend=False,
                  **kwargs):
         super(TabNetClassification, self).__init__(**kwargs)
 
@@ -210,9 +390,13 @@ class TabNetClassification(tf.keras.Model):
                              batch_momentum=batch_momentum,
                              virtual_batch_size=virtual_batch_size,
                              lambd_sparsity=lambd_sparsity,
+                             jit_compile=jit_compile,
+                             cpu_backend=cpu_backend,
                              **kwargs)
 
-        self.clf = tf.keras.layers.Dense(num_classes, activation='softmax', use_bias=False)
+        # The head runs in the variable dtype, i.e. float32 under mixed precision, so that the outputs are stable.
+        self.clf = tf.keras.layers.Dense(num_classes, activation='softmax', use_bias=False,
+                                         dtype=self.dtype_policy.variable_dtype)
 
     def call(self, inputs, training=None):
         self.activations, self.total_entropy = self.tabnet(inputs, training=training)
@@ -220,6 +404,12 @@ class TabNetClassification(tf.keras.Model):
 
         return out
 
+    def freeze_for_inference(self, fold_bn=True):
+        """Prepares the batch norm layers of the TabNet encoder for inference."""
+        self.tabnet.freeze_for_inference(fold_bn=fold_bn)
+        self.predict_function = None
+        self.test_function = None
+
 
 class TabNetRegression(tf.keras.Model):
 
@@ -233,6 +423,8 @@ class TabNetRegression(tf.keras.Model):
                  batch_momentum=0.98,
                  virtual_batch_size=None,
                  lambd_sparsity=1e-5,
+                 jit_compile=False,
+                 cpu_backend=False,
                  **kwargs):
         super(TabNetRegression, self).__init__(**kwargs)
 
@@ -247,11 +439,51 @@ class TabNetRegression(tf.keras.Model):
                              batch_momentum=batch_momentum,
                              virtual_batch_size=virtual_batch_size,
                              lambd_sparsity=lambd_sparsity,
+                             jit_compile=jit_compile,
+                             cpu_backend=cpu_backend,
                              **kwargs)
 
-        self.regressor = tf.keras.layers.Dense(num_regressors, use_bias=False)
+        # The head runs in the variable dtype, i.e. float32 under mixed precision, so that the outputs are stable.
+        self.regressor = tf.keras.layers.Dense(num_regressors, use_bias=False,
+                                               dtype=self.dtype_policy.variable_dtype)
 
     def call(self, inputs, training=None):
         self.activations, self.total_entropy = self.tabnet(inputs, training=training)
         out = self.regressor(self.activations)
         return out
+
+    def freeze_for_inference(self, fold_bn=True):
+        """Prepares the batch norm layers of the TabNet encoder for inference."""
+        self.tabnet.freeze_for_inference(fold_bn=fold_bn)
+        self.predict_function = None
+        self.test_function = None
+
+
+def export_for_serving(model, export_dir, batch_size=1):
+    """Saves a TabNet model with a fixed shape `serving_default` signature.
+
+    The exported SavedModel can be compiled ahead of time into a standalone library with
+    `saved_model_cli aot_compile_cpu`. The model must receive dense inputs, i.e. be built
+    with `feature_columns=None`, and should be frozen for inference beforehand.
+
+    Args:
+        model: `TabNet`, `TabNetClassification` or `TabNetRegression` model.
+        export_dir: directory in which the SavedModel is written.
+        batch_size: fixed batch size of the serving signature.
+    """
+    tabnet = model if isinstance(model, TabNet) else model.tabnet
+    if tabnet.input_features is not None:
+        raise ValueError("Only models built with `feature_columns=None` can be exported for serving.")
+
+    if tabnet.cpu_backend:
+        raise ValueError("Models built with `cpu_backend=True` cannot be exported, as Numba kernels are not serializable.")
+
+    @tf.function(input_signature=[tf.TensorSpec([batch_size, tabnet.num_features], tf.float32, name='features')])
+    def serve(features):
+        outputs = model(features, training=False)
+        if model is tabnet:
+            outputs, _ = outputs
+
+        return {'outputs': outputs}
+
+    tf.saved_model.save(model, export_dir, signatures={'serving_default': serve})